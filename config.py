@@ -21,11 +21,22 @@ if not GEMINI_API_KEY:
 MAX_HISTORY = 10
 MAX_TELEGRAM_MESSAGE_LEN = 4000
 
+# Кеш скачанных из Telegram файлов (по file_unique_id)
+DOWNLOAD_CACHE_MAX_ENTRIES = 32
+DOWNLOAD_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
 # --- LLM ---
 GEMINI_MODEL = "gemini-2.5-flash-lite-preview-09-2025"
 
 LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "gemini")
 
+# Batch mode Gemini: дешевле, но ответ приходит с задержкой до нескольких минут
+GEMINI_BATCHING = os.environ.get("GEMINI_BATCHING", "").lower() in ("1", "true", "yes")
+
+# --- Context store ---
+CONTEXT_STORE = os.environ.get("CONTEXT_STORE", "memory")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
 # --- Prompts ---
 SYSTEM_PROMPT = """
 Твоя роль: AI-эксперт по анализу и суммаризации текста.
@@ -1,22 +1,29 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from typing import Literal, TypedDict, List, Optional
+from typing import Literal, NotRequired, TypedDict, List, Optional
 
 
-class ImagePart(TypedDict):
-    data: bytes
+class MediaPart(TypedDict):
+    """
+    Вложение сообщения: либо байты (data), либо – в истории – ссылка на файл,
+    уже загруженный к провайдеру LLM (uri и unix-время истечения expires_at).
+    """
+    data: NotRequired[bytes | bytearray]
     mime_type: str
+    uri: NotRequired[str]
+    expires_at: NotRequired[float]
 
 
-class AudioPart(TypedDict):
-    data: bytes
-    mime_type: str
+class ImagePart(MediaPart):
+    pass
 
 
-class FilePart(TypedDict):
-    data: bytes
-    mime_type: str
+class AudioPart(MediaPart):
+    pass
+
+
+class FilePart(MediaPart):
     name: str | None
 
 
@@ -43,6 +50,17 @@ class LLMClient(ABC):
         """
         raise NotImplementedError
 
+    async def offload_media(self, message: ChatMessage) -> None:
+        """
+        Готовит вложения уже отправленного сообщения к хранению в истории
+        (in-place): заменяет data ссылкой uri/expires_at, если провайдер это
+        умеет. По умолчанию ничего не делает – такие вложения заменяются
+        текстовой пометкой.
+        """
+
+    async def aclose(self) -> None:
+        """Освобождает сетевые ресурсы клиента. По умолчанию ничего не делает."""
+
 
 class LLMError(Exception):
     """Базовая ошибка для всех проблем."""
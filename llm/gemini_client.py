@@ -1,10 +1,16 @@
 from __future__ import annotations
 
 import asyncio
-from typing import List, Dict, Any, Optional
+import hashlib
+import io
+import time
+from functools import lru_cache
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
 
+import httpx
 from google import genai
 from google.genai import errors as genai_errors
+from google.genai import types as genai_types
 
 from config import GEMINI_API_KEY, GEMINI_MODEL, logger
 from .base import (
@@ -16,31 +22,263 @@ from .base import (
 )
 
 
+# Пул соединений к Gemini: держим keep-alive между сообщениями пользователей,
+# чтобы не платить за TCP+TLS handshake на каждый запрос
+GEMINI_HTTP_LIMITS = httpx.Limits(
+    max_keepalive_connections=50,
+    max_connections=200,
+    keepalive_expiry=120,
+)
+GEMINI_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+# genai передаёт timeout в каждый запрос явно (None – без ограничения) и этим
+# перекрывает таймаут httpx-клиента, поэтому задаём его и в HttpOptions (мс)
+GEMINI_REQUEST_TIMEOUT_MS = 60_000
+
+# Вложения крупнее порога загружаем через Files API один раз и дальше
+# ссылаемся на них по URI; мелкие дешевле отправить inline одним запросом
+GEMINI_INLINE_MAX_BYTES = 1024 * 1024
+
+# Gemini хранит загруженные файлы 48 часов; берём с запасом
+GEMINI_FILE_TTL_SECONDS = 47 * 60 * 60
+GEMINI_FILE_POLL_INTERVAL = 1.0
+GEMINI_FILE_PROCESSING_TIMEOUT = 120.0
+
+# Batch mode (опционально): окно накопления запросов, размер пачки и опрос задачи
+GEMINI_BATCH_WINDOW_SECONDS = 0.05
+GEMINI_BATCH_MAX_SIZE = 8
+GEMINI_BATCH_POLL_INTERVAL = 5.0
+# Дольше ответа пользователь не ждёт: задачу отменяем, запросы завершаем LLMError
+GEMINI_BATCH_MAX_WAIT_SECONDS = 300.0
+# PARTIALLY_SUCCEEDED – тоже итог: ошибки отдельных запросов лежат в item.error
+_BATCH_OK_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
+_BATCH_DONE_STATES = {
+    *_BATCH_OK_STATES,
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+# Роли нашего формата -> роли Gemini (system уходит в system_instruction)
+_ROLE_MAP = {"user": "user", "assistant": "model"}
+
+# Поля с вложениями и mime-type по умолчанию для каждого
+_MEDIA_KEYS = (
+    ("images", "image/jpeg"),
+    ("audios", "audio/ogg"),
+    ("files", "application/octet-stream"),
+)
+
+
+@lru_cache(maxsize=8)
+def _system_config(text: str) -> genai_types.GenerateContentConfig:
+    """
+    Конфиг запроса с системным промптом в нативном system_instruction.
+    Промпт одинаков во всех запросах, поэтому конфиг создаётся один раз;
+    стабильный префикс к тому же позволяет Gemini применять implicit caching.
+    """
+    return genai_types.GenerateContentConfig(system_instruction=text)
+
+
+class _Batcher:
+    """
+    Склеивает запросы, пришедшие в пределах короткого окна, в одну batch-задачу
+    Gemini (batches.create с inlined_requests). Batch mode дешевле и разгружает
+    квоту, но ответ приходит с задержкой, поэтому включается только явно.
+    """
+
+    def __init__(
+        self,
+        client: genai.Client,
+        model: str,
+        window: float = GEMINI_BATCH_WINDOW_SECONDS,
+        max_size: int = GEMINI_BATCH_MAX_SIZE,
+        poll_interval: float = GEMINI_BATCH_POLL_INTERVAL,
+        max_wait: float = GEMINI_BATCH_MAX_WAIT_SECONDS,
+    ):
+        self._client = client
+        self._model = model
+        self._window = window
+        self._max_size = max_size
+        self._poll_interval = poll_interval
+        self._max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._jobs: set[asyncio.Task] = set()
+
+    async def submit(
+        self,
+        contents: List[genai_types.Content],
+        config: Optional[genai_types.GenerateContentConfig] = None,
+    ) -> Any:
+        # Очередь и воркер создаём лениво – в __init__ event loop ещё может не работать
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._collect())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((future, contents, config))
+        return await future
+
+    async def aclose(self) -> None:
+        tasks = [t for t in (self._worker, *self._jobs) if t is not None]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+        self._jobs.clear()
+
+        # Запросы, которые ещё не попали в пачку, иначе их submit() ждал бы вечно
+        while self._queue is not None and not self._queue.empty():
+            future, _, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(LLMError("Gemini batcher is closed"))
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        batch: List[Tuple[asyncio.Future, Any, Any]] = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                deadline = loop.time() + self._window
+
+                while len(batch) < self._max_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                # Пока задача выполняется, следующая пачка уже собирается
+                job = asyncio.create_task(self._run_batch(batch))
+                self._jobs.add(job)
+                job.add_done_callback(self._jobs.discard)
+                batch = []
+
+        except asyncio.CancelledError:
+            # Недособранная пачка: в batch job она так и не ушла
+            for future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(LLMError("Gemini batcher is closed"))
+            raise
+
+    async def _run_batch(self, batch: List[Tuple[asyncio.Future, Any, Any]]) -> None:
+        try:
+            logger.info("Sending batch of %d requests to Gemini", len(batch))
+            job = await self._client.aio.batches.create(
+                model=self._model,
+                src=[
+                    {"contents": contents, "config": config}
+                    for _, contents, config in batch
+                ],
+            )
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self._max_wait
+            while getattr(job.state, "name", job.state) not in _BATCH_DONE_STATES:
+                if loop.time() >= deadline:
+                    await self._cancel_job(job.name)
+                    raise LLMError(
+                        f"Gemini batch job {job.name} did not finish in {self._max_wait:g}s"
+                    )
+                await asyncio.sleep(self._poll_interval)
+                job = await self._client.aio.batches.get(name=job.name)
+
+            state = getattr(job.state, "name", job.state)
+            if state not in _BATCH_OK_STATES:
+                raise LLMError(f"Gemini batch job {job.name} finished with state {state}")
+
+            responses = job.dest.inlined_responses if job.dest else None
+            if not responses or len(responses) != len(batch):
+                raise LLMError(f"Gemini batch job {job.name} returned unexpected responses")
+
+            for (future, _, _), item in zip(batch, responses):
+                if future.done():
+                    continue
+                if item.error:
+                    future.set_exception(LLMError(f"Gemini batch request failed: {item.error}"))
+                else:
+                    future.set_result(item.response)
+
+        except asyncio.CancelledError:
+            for future, _, _ in batch:
+                future.cancel()
+            raise
+
+        except Exception as e:
+            for future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _cancel_job(self, name: str) -> None:
+        # Отмена – best effort: результат уже никто не ждёт
+        try:
+            await self._client.aio.batches.cancel(name=name)
+        except Exception:
+            logger.warning("Failed to cancel Gemini batch job %s", name, exc_info=True)
+
+
 class GeminiClient(LLMClient):
-    def __init__(self, api_key: str = GEMINI_API_KEY, model: str = GEMINI_MODEL):
-        self._client = genai.Client(api_key=api_key)
+    def __init__(
+        self,
+        api_key: str = GEMINI_API_KEY,
+        model: str = GEMINI_MODEL,
+        batching: bool = False,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
+        if http_client is not None:
+            # Внешний клиент (общий пул соединений процесса) – закрывает его владелец
+            http_options = genai_types.HttpOptions(
+                httpx_async_client=http_client,
+                timeout=GEMINI_REQUEST_TIMEOUT_MS,
+            )
+        else:
+            http_options = genai_types.HttpOptions(
+                async_client_args={
+                    "limits": GEMINI_HTTP_LIMITS,
+                    "timeout": GEMINI_HTTP_TIMEOUT,
+                },
+                timeout=GEMINI_REQUEST_TIMEOUT_MS,
+            )
+        self._client = genai.Client(api_key=api_key, http_options=http_options)
         self._model = model
+        # blake2b(data) -> (file_uri, expires_at – unix-время, как и в истории)
+        self._uploaded_files: Dict[bytes, Tuple[str, float]] = {}
+        self._batcher = _Batcher(self._client, model) if batching else None
+
+    async def aclose(self) -> None:
+        """Закрывает async-транспорт genai (пул соединений)."""
+        if self._batcher is not None:
+            await self._batcher.aclose()
+        await self._client.aio.aclose()
 
     async def generate(self, messages: List[ChatMessage]) -> Optional[str]:
         """
         Основной метод: принимает "универсальные" сообщения, конвертирует
         в формат Gemini и возвращает текст ответа.
         """
-        contents = self._convert_messages_for_gemini(messages)
-        loop = asyncio.get_running_loop()
-
-        def _request() -> Optional[str]:
-            resp = self._client.models.generate_content(
-                model=self._model,
-                contents=contents,
-            )
-            return getattr(resp, "text", None)
+        # Системный промпт передаём через system_instruction, а не user-ходом
+        system_text = "\n\n".join(
+            m["content"] for m in messages if m.get("role") == "system" and m.get("content")
+        )
+        config = _system_config(system_text) if system_text else None
 
-        logger.info("Sending request to Gemini")
         try:
-            result = await loop.run_in_executor(None, _request)
+            # SDK принимает только list, поэтому собираем contents один раз здесь
+            contents = [c async for c in self._iter_contents(messages)]
+
+            logger.info("Sending request to Gemini")
+            if self._batcher is not None:
+                resp = await self._batcher.submit(contents, config)
+            else:
+                # Нативный async-клиент genai: запрос не занимает поток из executor'а
+                resp = await self._client.aio.models.generate_content(
+                    model=self._model,
+                    contents=contents,
+                    config=config,
+                )
             logger.info("Response from Gemini received")
-            return result
+            return getattr(resp, "text", None)
 
         except genai_errors.ClientError as e:
             status, body = self._extract_http_info(e)
@@ -70,6 +308,9 @@ class GeminiClient(LLMClient):
 
             raise LLMError(f"Gemini server error (status={status})") from e
 
+        except LLMError:
+            raise
+
         except Exception:
             logger.exception("Unexpected error while calling Gemini")
             raise LLMError("Unexpected error while calling Gemini")
@@ -94,82 +335,145 @@ class GeminiClient(LLMClient):
         return status, body
 
 
-    @staticmethod
-    def _convert_messages_for_gemini(messages: List[ChatMessage]) -> List[Dict[str, Any]]:
+    async def _media_part(
+        self, data: bytes | bytearray, mime_type: str
+    ) -> genai_types.Part:
+        """
+        Part для бинарного вложения: мелкие – inline_data,
+        крупные – file_data со ссылкой на файл, загруженный через Files API.
+        bytearray из загрузчика передаём как есть: единственную копию в bytes
+        делает pydantic в Part.from_bytes, хешу и BytesIO копия не нужна.
+        """
+        if len(data) <= GEMINI_INLINE_MAX_BYTES:
+            return genai_types.Part.from_bytes(data=data, mime_type=mime_type)
+
+        file_uri, _ = await self._upload_file(data, mime_type)
+        return genai_types.Part.from_uri(file_uri=file_uri, mime_type=mime_type)
+
+    async def offload_media(self, message: ChatMessage) -> None:
+        """
+        Заменяет байты вложений ссылками на файлы в Files API, чтобы на
+        следующих ходах модель по-прежнему видела вложение, а байты не
+        пересылались заново. Крупные вложения уже загружены в generate() –
+        для них URI берётся из кеша. Ошибка загрузки не фатальна: вложение
+        остаётся с data и в историю попадёт только пометка о нём.
+        """
+        for key, default_mime in _MEDIA_KEYS:
+            for item in message.get(key) or ():
+                if "data" not in item:
+                    continue
+                mime_type = item.get("mime_type", default_mime)
+                try:
+                    uri, expires_at = await self._upload_file(item["data"], mime_type)
+                except Exception:
+                    logger.warning(
+                        "Failed to upload %s attachment for history", mime_type, exc_info=True
+                    )
+                    continue
+                del item["data"]
+                item["uri"] = uri
+                item["expires_at"] = expires_at
+
+    async def _upload_file(
+        self, data: bytes | bytearray, mime_type: str
+    ) -> Tuple[str, float]:
         """
-        Конвертация в формат Gemini:
+        Загружает файл через Files API, кешируя URI по хешу содержимого.
+        Повторная отправка тех же байт (пересланное медиа, повтор вопроса)
+        обходится без повторной загрузки. Возвращает (uri, expires_at).
+        """
+        now = time.time()
+        expired = [k for k, (_, exp) in self._uploaded_files.items() if exp <= now]
+        for k in expired:
+            del self._uploaded_files[k]
+
+        key = hashlib.blake2b(data, digest_size=16).digest()
+        cached = self._uploaded_files.get(key)
+        if cached is not None:
+            return cached
+
+        logger.info("Uploading %d bytes (%s) to Gemini Files API", len(data), mime_type)
+        uploaded = await self._client.aio.files.upload(
+            file=io.BytesIO(data),
+            config={"mime_type": mime_type},
+        )
+
+        # Видео/аудио обрабатываются асинхронно – ждём, пока файл станет ACTIVE
+        deadline = time.monotonic() + GEMINI_FILE_PROCESSING_TIMEOUT
+        while getattr(uploaded.state, "name", uploaded.state) == "PROCESSING":
+            if time.monotonic() >= deadline:
+                raise LLMError(
+                    f"Gemini did not process uploaded file {uploaded.name} "
+                    f"in {GEMINI_FILE_PROCESSING_TIMEOUT:g}s"
+                )
+            await asyncio.sleep(GEMINI_FILE_POLL_INTERVAL)
+            uploaded = await self._client.aio.files.get(name=uploaded.name)
+
+        state = getattr(uploaded.state, "name", uploaded.state)
+        if state == "FAILED":
+            raise LLMError(f"Gemini failed to process uploaded file {uploaded.name}")
+
+        entry = self._uploaded_files[key] = (uploaded.uri, now + GEMINI_FILE_TTL_SECONDS)
+        return entry
+
+    async def _iter_contents(
+        self,
+        messages: List[ChatMessage],
+    ) -> AsyncIterator[genai_types.Content]:
+        """
+        Конвертация в формат Gemini (сразу в объекты genai.types,
+        чтобы SDK не перегонял промежуточные dict'ы в свои модели).
+        Генератор: contents отдаются по одному, без промежуточного списка.
+
+        System-сообщения пропускаются – они передаются через system_instruction.
+
         вход:
         {
-            "role": "user"/"assistant"/"system",
+            "role": "user"/"assistant",
             "content": "...",
             "images": [{"data": bytes, "mime_type": "image/jpeg"}, ...]
             "files":  [{"data": bytes, "mime_type": "application/pdf", "name": "file.pdf"}, ...]
             "audios": [{"data": bytes, "mime_type": "audio/ogg"}, ...]
         }
+        Вложения из истории вместо data несут uri и expires_at (см. offload_media).
 
         выход:
-        {
-            "role": "user"/"model",
-            "parts": [...]
-        }
+        types.Content(role="user"/"model", parts=[types.Part, ...])
         """
-        converted: List[Dict[str, Any]] = []
-
         for msg in messages:
             role = msg.get("role", "user")
 
-            if role == "assistant":
-                role = "model"
-            elif role == "system":
-                # У Gemini нет system – передаём как user
-                role = "user"
+            if role == "system":
+                continue
 
-            parts: List[Dict[str, Any]] = []
+            role = _ROLE_MAP.get(role, "user")
+            parts: List[genai_types.Part] = []
 
             content = msg.get("content")
             if content:
-                parts.append({"text": content})
-
-            images = msg.get("images") or []
-            for img in images:
-                data = bytes(img["data"])
-                mime_type = img.get("mime_type", "image/jpeg")
-                parts.append(
-                    {
-                        "inline_data": {
-                            "mime_type": mime_type,
-                            "data": data,
-                        }
-                    }
-                )
+                parts.append(genai_types.Part.from_text(text=content))
 
-            audios = msg.get("audios") or []
-            for a in audios:
-                data = bytes(a["data"])
-                mime_type = a.get("mime_type", "audio/ogg")
-                parts.append(
-                    {
-                        "inline_data": {
-                            "mime_type": mime_type,
-                            "data": data,
-                        }
-                    }
-                )
-
-            files = msg.get("files") or []
-            for f in files:
-                data = bytes(f["data"])
-                mime_type = f.get("mime_type", "application/octet-stream")
-                parts.append(
-                    {
-                        "inline_data": {
-                            "mime_type": mime_type,
-                            "data": data,
-                        }
-                    }
-                )
+            for key, default_mime in _MEDIA_KEYS:
+                items = msg.get(key)
+                if items:
+                    for item in items:
+                        mime_type = item.get("mime_type", default_mime)
+                        if "data" in item:
+                            parts.append(await self._media_part(item["data"], mime_type))
+                        elif item["expires_at"] > time.time():
+                            # Вложение из истории – ссылка на файл в Files API
+                            parts.append(
+                                genai_types.Part.from_uri(
+                                    file_uri=item["uri"], mime_type=mime_type
+                                )
+                            )
+                        else:
+                            # Gemini уже удалил файл – модель узнает только о нём
+                            parts.append(
+                                genai_types.Part.from_text(
+                                    text=f"[вложение {mime_type} больше недоступно]"
+                                )
+                            )
 
             if parts:
-                converted.append({"role": role, "parts": parts})
-
-        return converted
+                yield genai_types.Content(role=role, parts=parts)
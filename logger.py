@@ -1,26 +1,42 @@
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from pathlib import Path
 
 
+def _console_level_from_env(default: int = logging.WARNING) -> int:
+    """
+    Уровень консольного лога из LOG_LEVEL_CONSOLE (DEBUG/INFO/WARNING/...).
+    В проде консоль по умолчанию показывает только WARNING+, полный лог пишется в файл.
+    """
+    name = os.environ.get("LOG_LEVEL_CONSOLE")
+    if not name:
+        return default
+    level = logging.getLevelName(name.strip().upper())
+    return level if isinstance(level, int) else default
+
+
 def setup_logger(
     logger_name: str = "telegram_assist",
     log_dir: str | Path = "logs",
     level: int = logging.INFO,
+    console_level: int | None = None,
 ):
-    log_dir = Path(log_dir)
-    log_dir.mkdir(parents=True, exist_ok=True)
-
-    log_file = log_dir / "app.log"
-
     logger = logging.getLogger(logger_name)
     logger.setLevel(level)
 
     if logger.handlers:
         return logger
 
-    if logger.handlers:
-        return logger
+    log_dir = Path(log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    log_file = log_dir / "app.log"
+
+    if console_level is None:
+        console_level = _console_level_from_env()
 
     formatter = logging.Formatter(
         "%(asctime)s %(levelname)s %(message)s"
@@ -40,9 +56,21 @@ def setup_logger(
     # Console handler
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    console_handler.setLevel(level)
+    console_handler.setLevel(console_level)
+
+    # Запись на диск/в консоль и ротация файла выполняются в фоновом потоке
+    # QueueListener, в event loop остаётся только queue.put
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(
+        log_queue,
+        file_handler,
+        console_handler,
+        respect_handler_level=True,
+    )
+    listener.start()
+    atexit.register(listener.stop)
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.queue_listener = listener
 
     return logger
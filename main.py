@@ -1,17 +1,37 @@
 #!/usr/bin/env python3
 
+import httpx
 from telegram.ext import ApplicationBuilder
+from telegram.request import HTTPXRequest
 from telegram_bot.handlers import create_handlers
+from telegram_bot.message_adapter import set_download_client
 
-from config import TELEGRAM_TOKEN, MAX_HISTORY, LLM_PROVIDER, logger
-from llm.gemini_client import GeminiClient
+from config import (
+    TELEGRAM_TOKEN,
+    MAX_HISTORY,
+    LLM_PROVIDER,
+    GEMINI_BATCHING,
+    CONTEXT_STORE,
+    REDIS_URL,
+    logger,
+)
+from llm.gemini_client import GEMINI_HTTP_TIMEOUT, GeminiClient
+from storage.base import BaseContextStore
 from storage.memory import MemoryContextStore
 
+# Общий пул соединений для Telegram Bot API и LLM: один транспорт,
+# один набор keep-alive соединений и таймеров на процесс
+SHARED_HTTP_LIMITS = httpx.Limits(
+    max_connections=400,
+    max_keepalive_connections=100,
+    keepalive_expiry=120,
+)
 
-def build_llm_client():
+
+def build_llm_client(http_client: httpx.AsyncClient | None = None):
     if LLM_PROVIDER == "gemini":
         logger.info("Using Gemini LLM provider")
-        return GeminiClient()
+        return GeminiClient(batching=GEMINI_BATCHING, http_client=http_client)
     # elif LLM_PROVIDER == "openai":
     #     logger.info("Using openai LLM provider")
     #     return OpenAIClient(...)
@@ -22,11 +42,47 @@ def build_llm_client():
         raise ValueError(f"Unsupported LLM_PROVIDER: {LLM_PROVIDER}")
 
 
+def build_context_store() -> BaseContextStore:
+    if CONTEXT_STORE == "memory":
+        logger.info("Using in-memory context store")
+        return MemoryContextStore(max_history=MAX_HISTORY)
+    elif CONTEXT_STORE == "redis":
+        # redis – опциональная зависимость, импортируем только при выборе бэкенда
+        from storage.redis import RedisContextStore
+
+        logger.info("Using Redis context store")
+        return RedisContextStore(REDIS_URL, max_history=MAX_HISTORY)
+    else:
+        raise ValueError(f"Unsupported CONTEXT_STORE: {CONTEXT_STORE}")
+
+
 def main() -> None:
-    llm_client = build_llm_client()
-    context_store = MemoryContextStore(max_history=MAX_HISTORY)
+    shared_transport = httpx.AsyncHTTPTransport(limits=SHARED_HTTP_LIMITS)
+    shared_http = httpx.AsyncClient(transport=shared_transport, timeout=GEMINI_HTTP_TIMEOUT)
+
+    llm_client = build_llm_client(http_client=shared_http)
+    set_download_client(shared_http)
+    context_store = build_context_store()
+
+    async def post_shutdown(_application) -> None:
+        await llm_client.aclose()
+        await context_store.aclose()
+        await shared_http.aclose()
 
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Long polling (getUpdates) остаётся на отдельном пуле PTB,
+    # чтобы висящий запрос не занимал соединение общего пула.
+    # Апдейты обрабатываются конкурентно: сообщения разных пользователей
+    # (скачивание вложений, запросы к LLM) идут параллельно, а сообщения
+    # одного пользователя handle_message целиком выполняет под
+    # context_store.lock() в порядке поступления
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .request(HTTPXRequest(httpx_kwargs={"transport": shared_transport}))
+        .concurrent_updates(True)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     handlers = create_handlers(llm_client, context_store)
     for h in handlers:
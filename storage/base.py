@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import asyncio
+import weakref
 from abc import ABC, abstractmethod
 from typing import List, Dict, Any
 
@@ -7,14 +9,31 @@ from typing import List, Dict, Any
 class BaseContextStore(ABC):
     """Базовый интерфейс для хранилища контекста (память, Redis, БД и т.п.)."""
 
+    def __init__(self) -> None:
+        # Блокировка живёт, пока её держат или ждут (ссылку хранит async with),
+        # поэтому словарь не растёт с числом всех, кто когда-либо писал боту
+        self._locks: weakref.WeakValueDictionary[int, asyncio.Lock] = (
+            weakref.WeakValueDictionary()
+        )
+
     @abstractmethod
-    def get_history(self, user_id: int) -> List[Dict[str, Any]]:
+    async def get_history(self, user_id: int) -> List[Dict[str, Any]]:
         raise NotImplementedError
 
     @abstractmethod
-    def append_message(self, user_id: int, message: Dict[str, Any]) -> None:
+    async def append_message(self, user_id: int, message: Dict[str, Any]) -> None:
         raise NotImplementedError
 
     @abstractmethod
-    def reset(self, user_id: int) -> None:
+    async def reset(self, user_id: int) -> None:
         raise NotImplementedError
+
+    def lock(self, user_id: int) -> asyncio.Lock:
+        """Блокировка, сериализующая работу с историей одного пользователя."""
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def aclose(self) -> None:
+        """Освобождает соединения хранилища; по умолчанию ничего не делает."""
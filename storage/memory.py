@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from typing import Dict, List, Any
+from collections import deque
+from typing import Deque, Dict, List, Any, Optional
 
 from .base import BaseContextStore
 
@@ -13,17 +14,33 @@ class MemoryContextStore(BaseContextStore):
     """
 
     def __init__(self, max_history: int = 10):
-        self._store: Dict[int, List[Dict[str, Any]]] = {}
+        super().__init__()
+        # deque(maxlen=...) сам вытесняет старые сообщения при append – без слайсов
+        self._store: Dict[int, Deque[Dict[str, Any]]] = {}
         self._max_history = max_history
-
-    def get_history(self, user_id: int) -> List[Dict[str, Any]]:
-        return self._store.get(user_id, [])
-
-    def append_message(self, user_id: int, message: Dict[str, Any]) -> None:
-        history = self._store.setdefault(user_id, [])
+        # Последний пользователь, которому дописывали историю: в диалоге
+        # user -> assistant оба append идут подряд для одного user_id
+        self._last_user_id: Optional[int] = None
+        self._last_history: Optional[Deque[Dict[str, Any]]] = None
+
+    async def get_history(self, user_id: int) -> List[Dict[str, Any]]:
+        return list(self._store.get(user_id, ()))
+
+    async def append_message(self, user_id: int, message: Dict[str, Any]) -> None:
+        if user_id == self._last_user_id:
+            self._last_history.append(message)
+            return
+
+        history = self._store.get(user_id)
+        if history is None:
+            history = self._store[user_id] = deque(maxlen=self._max_history)
         history.append(message)
-        if len(history) > self._max_history:
-            self._store[user_id] = history[-self._max_history :]
 
-    def reset(self, user_id: int) -> None:
+        self._last_user_id = user_id
+        self._last_history = history
+
+    async def reset(self, user_id: int) -> None:
         self._store.pop(user_id, None)
+        if user_id == self._last_user_id:
+            self._last_user_id = None
+            self._last_history = None
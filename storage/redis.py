@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from typing import Dict, List, Any
+
+import redis.asyncio as redis
+
+from . import serde
+from .base import BaseContextStore
+
+
+class RedisContextStore(BaseContextStore):
+    """
+    Хранилище контекста в Redis: история пользователя – список
+    сериализованных сообщений, обрезаемый до max_history.
+    Клиент асинхронный, чтобы запросы к Redis не блокировали event loop.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        max_history: int = 10,
+        key_prefix: str = "telegram_assist:history",
+    ):
+        super().__init__()
+        self._redis = redis.Redis.from_url(url)
+        self._max_history = max_history
+        self._key_prefix = key_prefix
+
+    def _key(self, user_id: int) -> str:
+        return f"{self._key_prefix}:{user_id}"
+
+    async def get_history(self, user_id: int) -> List[Dict[str, Any]]:
+        raw_messages = await self._redis.lrange(self._key(user_id), 0, -1)
+        return [serde.loads(raw) for raw in raw_messages]
+
+    async def append_message(self, user_id: int, message: Dict[str, Any]) -> None:
+        key = self._key(user_id)
+        async with self._redis.pipeline() as pipe:
+            pipe.rpush(key, serde.dumps(message))
+            pipe.ltrim(key, -self._max_history, -1)
+            await pipe.execute()
+
+    async def reset(self, user_id: int) -> None:
+        await self._redis.delete(self._key(user_id))
+
+    async def aclose(self) -> None:
+        await self._redis.aclose()
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import base64
+
+import orjson
+
+from llm.base import ChatMessage
+
+# Поля ChatMessage с вложениями: [{"data": bytes, ...}, ...]; вложения-ссылки
+# ({"uri": ..., "expires_at": ...}) без data сериализуются как есть
+_MEDIA_KEYS = ("images", "audios", "files")
+
+
+def dumps(message: ChatMessage) -> bytes:
+    """
+    Сериализует ChatMessage для внешнего хранилища (Redis/БД).
+    Бинарные данные вложений кодируются base85 (компактнее base64).
+    """
+    data = dict(message)
+    for key in _MEDIA_KEYS:
+        items = message.get(key)
+        if items:
+            data[key] = [
+                {**item, "data": base64.b85encode(item["data"]).decode("ascii")}
+                if "data" in item
+                else item
+                for item in items
+            ]
+    return orjson.dumps(data)
+
+
+def loads(raw: bytes | str) -> ChatMessage:
+    """Обратная операция к dumps()."""
+    message = orjson.loads(raw)
+    for key in _MEDIA_KEYS:
+        items = message.get(key)
+        if items:
+            for item in items:
+                if "data" in item:
+                    item["data"] = base64.b85decode(item["data"])
+    return message
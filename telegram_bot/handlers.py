@@ -13,14 +13,34 @@ from telegram.ext import (
 from config import SYSTEM_PROMPT, logger
 from storage.base import BaseContextStore
 from telegram_bot.utils import convert_to_md_v2, split_md_v2
-from telegram_bot.message_adapter import parse_message, to_chat_message
+from telegram_bot.message_adapter import (
+    log_message_overview,
+    parse_message,
+    strip_media,
+    to_chat_message,
+)
 from llm.base import (
+    ChatMessage,
     LLMClient,
     LLMError,
     LLMOverloadedError,
     LLMQuotaExceededError,
 )
 
+# Системное сообщение одинаково для всех запросов – создаём один раз
+_SYSTEM_MESSAGE: ChatMessage = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Фильтр входящих сообщений собираем один раз при импорте
+_MESSAGE_FILTER = (
+    (filters.TEXT & ~filters.COMMAND)
+    | filters.PHOTO
+    | filters.Document.ALL
+    | filters.VOICE
+    | filters.AUDIO
+    | filters.VIDEO
+    | filters.VIDEO_NOTE
+)
+
 
 async def send_reply(message: Message, text: str) -> None:
     if not text or not text.strip():
@@ -81,7 +101,9 @@ def create_handlers(llm_client: LLMClient, context_store: BaseContextStore):
             return
 
         user_id = user.id
-        context_store.reset(user_id)
+        # Ждём текущий ответ, иначе он допишет историю уже после очистки
+        async with context_store.lock(user_id):
+            await context_store.reset(user_id)
 
         logger.info("Context reset for user %s", user_id)
         await message.reply_text("Контекст очищен 🧹")
@@ -96,86 +118,102 @@ def create_handlers(llm_client: LLMClient, context_store: BaseContextStore):
         user_id = user.id
         logger.info("User id: %s", user_id)
 
-        # Парсим входящее сообщение
-        parsed = await parse_message(message)
-        if parsed is None:
-            logger.warning("parse_message returned None")
-            await message.reply_text("Пока я понимаю только текст, изображения, файлы и аудио 🙂")
-            return
-
-        user_message = to_chat_message(parsed)
-        if user_message is None:
-            logger.warning("No text or supported media found, exiting")
-            await message.reply_text(
-                "Пока я понимаю только текст, изображения, файлы и аудио 🙂"
-            )
-            return
-
-        # Работа с контекстом
-        context_store.append_message(user_id, user_message)
-        history = context_store.get_history(user_id)
-
-        messages_for_llm = [
-            {"role": "system", "content": SYSTEM_PROMPT}
-        ] + history
-
-        # Запрос к LLM
-        try:
-            assistant_response = await llm_client.generate(messages_for_llm)
-            if not assistant_response:
-                logger.error("LLM returned empty text for user %s", user_id)
-                await message.reply_text("Не смог получить ответ от модели 😔")
+        # Сообщения одного пользователя обрабатываем строго по очереди – начиная
+        # со скачивания вложений: апдейты идут конкурентно, и без этого текст,
+        # отправленный после фото, мог бы попасть в модель раньше фото.
+        # Разные пользователи не блокируют друг друга (asyncio.Lock – FIFO)
+        async with context_store.lock(user_id):
+            user_message: ChatMessage | None
+            if message.text and not (
+                message.photo
+                or message.document
+                or message.voice
+                or message.audio
+                or message.video
+                or message.video_note
+            ):
+                # Быстрый путь для обычного текста – большая часть трафика;
+                # обзор сообщения логируем так же, как parse_message
+                log_message_overview(message)
+                user_message = {"role": "user", "content": message.text}
+            else:
+                # Парсим входящее сообщение
+                parsed = await parse_message(message)
+                if parsed is None:
+                    logger.warning("parse_message returned None")
+                    await message.reply_text("Пока я понимаю только текст, изображения, файлы и аудио 🙂")
+                    return
+
+                user_message = to_chat_message(parsed)
+
+            if user_message is None:
+                logger.warning("No text or supported media found, exiting")
+                await message.reply_text(
+                    "Пока я понимаю только текст, изображения, файлы и аудио 🙂"
+                )
                 return
 
-            # Сохраняем ответ ассистента в контекст
-            context_store.append_message(
-                user_id,
-                {"role": "assistant", "content": assistant_response},
-            )
-
-            await send_reply(message, assistant_response)
-
-        except LLMQuotaExceededError:
-            logger.warning("LLM quota exceeded (Gemini 429) for user %s", user_id)
-            await message.reply_text(
-                "Исчерпан доступный лимит запросов к модели. "
-                "Лимит скоро обновится. Пожалуйста, попробуй ещё раз чуть позже 🙂"
-            )
-
-        except LLMOverloadedError:
-            logger.warning("LLM overloaded (Gemini 503) for user %s", user_id)
-            await message.reply_text(
-                "Сейчас модель перегружена и временно недоступна. "
-                "Пожалуйста, попробуй ещё раз чуть позже 🙂"
-            )
-
-        except LLMError:
-            logger.exception(
-                "LLMError while getting response from LLM for user %s", user_id
-            )
-            await message.reply_text(
-                "Возникла ошибка при обращении к модели. "
-                "Скорее всего проблема на стороне сервиса LLM. "
-                "Пожалуйста, попробуй ещё раз чуть позже 🙂"
-            )
-
-        except Exception:
-            logger.exception(
-                "Unexpected error while processing message for user %s", user_id
-            )
-            await message.reply_text("Произошла непредвиденная ошибка, попробуйте позже.")
+            # Работа с контекстом
+            history = await context_store.get_history(user_id)
+
+            messages_for_llm = [_SYSTEM_MESSAGE, *history, user_message]
+
+            # Запрос к LLM
+            try:
+                assistant_response = await llm_client.generate(messages_for_llm)
+
+                if assistant_response:
+                    await send_reply(message, assistant_response)
+                else:
+                    logger.error("LLM returned empty text for user %s", user_id)
+                    await message.reply_text("Не смог получить ответ от модели 😔")
+
+                # Вложения уже ушли в модель – в историю вместо байт сохраняем
+                # ссылки на загруженные файлы, а где их нет – пометку. Делаем это
+                # после ответа, чтобы загрузка не задерживала его
+                await llm_client.offload_media(user_message)
+                strip_media(user_message)
+                await context_store.append_message(user_id, user_message)
+
+                if assistant_response:
+                    # Сохраняем ответ ассистента в контекст
+                    await context_store.append_message(
+                        user_id,
+                        {"role": "assistant", "content": assistant_response},
+                    )
+
+            except LLMQuotaExceededError:
+                logger.warning("LLM quota exceeded (Gemini 429) for user %s", user_id)
+                await message.reply_text(
+                    "Исчерпан доступный лимит запросов к модели. "
+                    "Лимит скоро обновится. Пожалуйста, попробуй ещё раз чуть позже 🙂"
+                )
+
+            except LLMOverloadedError:
+                logger.warning("LLM overloaded (Gemini 503) for user %s", user_id)
+                await message.reply_text(
+                    "Сейчас модель перегружена и временно недоступна. "
+                    "Пожалуйста, попробуй ещё раз чуть позже 🙂"
+                )
+
+            except LLMError:
+                logger.exception(
+                    "LLMError while getting response from LLM for user %s", user_id
+                )
+                await message.reply_text(
+                    "Возникла ошибка при обращении к модели. "
+                    "Скорее всего проблема на стороне сервиса LLM. "
+                    "Пожалуйста, попробуй ещё раз чуть позже 🙂"
+                )
+
+            except Exception:
+                logger.exception(
+                    "Unexpected error while processing message for user %s", user_id
+                )
+                await message.reply_text("Произошла непредвиденная ошибка, попробуйте позже.")
 
     return [
         CommandHandler("start", start),
         CommandHandler("reset", reset),
-        MessageHandler(
-            (filters.TEXT & ~filters.COMMAND)
-            | filters.PHOTO
-            | filters.Document.ALL
-            | filters.VOICE
-            | filters.AUDIO
-            | filters.VIDEO
-            | filters.VIDEO_NOTE,
-            handle_message,
-        ),
+        MessageHandler(_MESSAGE_FILTER, handle_message),
     ]
@@ -1,17 +1,26 @@
 from __future__ import annotations
 
+from collections import OrderedDict
 from dataclasses import dataclass
 from enum import Enum, auto
-from typing import Optional, Any, Dict, Tuple
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Optional, Any, Dict, Tuple
+import logging
 import mimetypes
 
+import httpx
+import orjson
 from telegram import Message, File
+from telegram.error import NetworkError
 
 from config import (
     DEFAULT_IMAGE_PROMPT,
     DEFAULT_FILE_PROMPT,
     DEFAULT_AUDIO_PROMPT,
     DEFAULT_VIDEO_PROMPT,
+    DOWNLOAD_CACHE_MAX_BYTES,
+    DOWNLOAD_CACHE_MAX_ENTRIES,
     logger,
 )
 from llm.base import ChatMessage
@@ -27,35 +36,85 @@ class ContentKind(Enum):
     VIDEO = auto()
 
 
-@dataclass
+@dataclass(slots=True)
 class ParsedContent:
     text: Optional[str] = None
 
-    image_bytes: Optional[bytes] = None
+    image_bytes: Optional[bytes | bytearray] = None
     image_mime_type: Optional[str] = None
 
-    file_bytes: Optional[bytes] = None
+    file_bytes: Optional[bytes | bytearray] = None
     file_mime_type: Optional[str] = None
     file_name: Optional[str] = None
 
-    audio_bytes: Optional[bytes] = None
+    audio_bytes: Optional[bytes | bytearray] = None
     audio_mime_type: Optional[str] = None
 
-    video_bytes: Optional[bytes] = None
+    video_bytes: Optional[bytes | bytearray] = None
     video_mime_type: Optional[str] = None
 
 
+# Результат разбора сообщения: тип контента + метаданные файла
+_Detected = Tuple[ContentKind, Dict[str, Any]]
+
+
+# Частые расширения: не трогаем mimetypes (его первая инициализация читает
+# системные mime.types с диска)
+_COMMON_MIME_TYPES = {
+    ".txt": "text/plain",
+    ".md": "text/markdown",
+    ".csv": "text/csv",
+    ".json": "application/json",
+    ".pdf": "application/pdf",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".mp3": "audio/mpeg",
+    ".ogg": "audio/ogg",
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+}
+
+
+@lru_cache(maxsize=256)
+def _guess_mime_by_ext(ext: str) -> Optional[str]:
+    """mime-type через mimetypes по составному расширению (".tar.gz"), с кешем."""
+    return mimetypes.guess_type("x" + ext)[0]
+
+
+def _guess_mime(file_name: str) -> Optional[str]:
+    """
+    mime-type по имени файла ("a.pdf" -> "application/pdf").
+    Сначала таблица по последнему суффиксу – в именах вида IMG_2024.01.05.jpg
+    точки встречаются часто; mimetypes получает все суффиксы (".tar.gz"),
+    так как различает составные расширения.
+    """
+    path = Path(file_name)
+    mime_type = _COMMON_MIME_TYPES.get(path.suffix.lower())
+    if mime_type is not None:
+        return mime_type
+    return _guess_mime_by_ext("".join(path.suffixes).lower())
+
+
 def log_message_overview(message: Message) -> None:
     """
     Логирует сводную информацию о входящем сообщении Telegram:
     какие типы контента присутствуют.
     """
+    # Сводка нужна только для INFO-лога – не собираем её, если он выключен
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
     from_user = message.from_user
+    from_id = from_user.id if from_user else None
+    username = from_user.username if from_user else None
     overview = {
         "message_id": message.message_id,
         "chat_id": message.chat_id,
-        "from_id": getattr(from_user, "id", None),
-        "username": getattr(from_user, "username", None),
+        "from_id": from_id,
+        "username": username,
         "has_text": bool(message.text),
         "has_photo": bool(message.photo),
         "has_document": bool(message.document),
@@ -69,10 +128,103 @@ def log_message_overview(message: Message) -> None:
         "has_contact": bool(message.contact),
     }
 
-    logger.info("Incoming Telegram message overview: %s", overview)
+    logger.info("Incoming Telegram message overview: %s", orjson.dumps(overview).decode())
+
+
+def _meta(
+    file: Any = None,
+    text: Optional[str] = None,
+    mime_type: Optional[str] = None,
+    file_name: Optional[str] = None,
+) -> Dict[str, Any]:
+    return {
+        "file": file,
+        "text": text,
+        "mime_type": mime_type,
+        "file_name": file_name,
+    }
+
+
+def _detect_photo(message: Message, photo: Any) -> _Detected:
+    logger.info("Image (Photo) detected")
+    return ContentKind.IMAGE, _meta(photo[-1], message.caption, "image/jpeg")
 
 
-def _detect_message_kind(message: Message) -> Tuple[ContentKind, Dict[str, Any]]:
+def _detect_image_document(message: Message, document: Any) -> Optional[_Detected]:
+    if not (document.mime_type and document.mime_type.startswith("image/")):
+        return None
+    logger.info("Image (Document) detected")
+    return ContentKind.IMAGE, _meta(document, message.caption, document.mime_type)
+
+
+def _detect_video(message: Message, video: Any) -> _Detected:
+    logger.info(
+        "Video detected: duration=%s mime_type=%s",
+        video.duration,
+        video.mime_type,
+    )
+    return ContentKind.VIDEO, _meta(video, message.caption, video.mime_type or "video/mp4")
+
+
+def _detect_video_note(message: Message, video_note: Any) -> _Detected:
+    logger.info(
+        "Video note (circle) detected: duration=%s length=%s",
+        video_note.duration,
+        video_note.length,
+    )
+    return ContentKind.VIDEO, _meta(video_note, message.caption, "video/mp4")
+
+
+def _detect_document(message: Message, document: Any) -> _Detected:
+    logger.info(
+        "Generic file detected: name=%s mime_type=%s",
+        document.file_name,
+        document.mime_type,
+    )
+    return ContentKind.FILE, _meta(
+        document, message.caption, document.mime_type, document.file_name
+    )
+
+
+def _detect_voice(message: Message, voice: Any) -> _Detected:
+    logger.info(
+        "Voice message detected: duration=%s mime_type=%s",
+        voice.duration,
+        voice.mime_type,
+    )
+    return ContentKind.VOICE, _meta(voice, message.caption, voice.mime_type or "audio/ogg")
+
+
+def _detect_audio(message: Message, audio: Any) -> _Detected:
+    logger.info(
+        "Audio file detected: title=%s mime_type=%s",
+        audio.file_name or audio.title,
+        audio.mime_type,
+    )
+    return ContentKind.AUDIO, _meta(audio, message.caption, audio.mime_type or "audio/mpeg")
+
+
+def _detect_text(message: Message, text: str) -> _Detected:
+    logger.info("Text message detected")
+    return ContentKind.TEXT, _meta(text=text)
+
+
+# Таблица разбора: (атрибут Message, обработчик). Порядок задаёт приоритет:
+# сначала медиа/файлы, потом чистый текст. Обработчик может вернуть None,
+# если атрибут есть, но не подходит (document, который не картинка)
+_DISPATCH: Tuple[Tuple[str, Callable[[Message, Any], Optional[_Detected]]], ...] = (
+    ("photo", _detect_photo),
+    ("document", _detect_image_document),
+    ("video", _detect_video),
+    ("video_note", _detect_video_note),
+    ("document", _detect_document),
+    ("voice", _detect_voice),
+    ("audio", _detect_audio),
+    ("text", _detect_text),
+)
+
+
+def _detect_message_kind(message: Message) -> _Detected:
     """
     Определяет тип контента и вытаскивает только "метаданные":
     - что за тип (IMAGE/FILE/VOICE/AUDIO/VIDEO/TEXT/NONE)
@@ -81,97 +233,141 @@ def _detect_message_kind(message: Message) -> Tuple[ContentKind, Dict[str, Any]]
     """
     log_message_overview(message)
 
-    meta: Dict[str, Any] = {
-        "file": None,
-        "text": None,
-        "mime_type": None,
-        "file_name": None,
-    }
+    for attr, detect in _DISPATCH:
+        value = getattr(message, attr)
+        if value:
+            detected = detect(message, value)
+            if detected is not None:
+                return detected
 
-    # Приоритет: сначала медиа/файлы, потом чистый текст
-    if message.photo:
-        logger.info("Image (Photo) detected")
-        meta["file"] = message.photo[-1]
-        meta["text"] = message.caption
-        meta["mime_type"] = "image/jpeg"
-        return ContentKind.IMAGE, meta
-
-    if (
-        message.document
-        and message.document.mime_type
-        and message.document.mime_type.startswith("image/")
-    ):
-        logger.info("Image (Document) detected")
-        meta["file"] = message.document
-        meta["text"] = message.caption
-        meta["mime_type"] = message.document.mime_type
-        return ContentKind.IMAGE, meta
-
-    if message.video:
-        logger.info(
-            "Video detected: duration=%s mime_type=%s",
-            message.video.duration,
-            message.video.mime_type,
-        )
-        meta["file"] = message.video
-        meta["text"] = message.caption
-        meta["mime_type"] = message.video.mime_type or "video/mp4"
-        return ContentKind.VIDEO, meta
+    logger.warning("Unsupported Telegram message type, no known content fields set")
 
-    if message.video_note:
-        logger.info(
-            "Video note (circle) detected: duration=%s length=%s",
-            message.video_note.duration,
-            message.video_note.length,
-        )
-        meta["file"] = message.video_note
-        meta["text"] = message.caption
-        meta["mime_type"] = "video/mp4"
-        meta["file_name"] = None
-        return ContentKind.VIDEO, meta
+    return ContentKind.NONE, _meta()
 
-    if message.document:
-        logger.info(
-            "Generic file detected: name=%s mime_type=%s",
-            message.document.file_name,
-            message.document.mime_type,
-        )
-        meta["file"] = message.document
-        meta["text"] = message.caption
-        meta["mime_type"] = message.document.mime_type
-        meta["file_name"] = message.document.file_name
-        return ContentKind.FILE, meta
 
-    if message.voice:
-        logger.info(
-            "Voice message detected: duration=%s mime_type=%s",
-            message.voice.duration,
-            message.voice.mime_type,
-        )
-        meta["file"] = message.voice
-        meta["text"] = message.caption
-        meta["mime_type"] = message.voice.mime_type or "audio/ogg"
-        return ContentKind.VOICE, meta
+# Промпт по умолчанию, если медиа пришло без подписи
+_DEFAULT_PROMPTS = {
+    ContentKind.IMAGE: DEFAULT_IMAGE_PROMPT,
+    ContentKind.FILE: DEFAULT_FILE_PROMPT,
+    ContentKind.VIDEO: DEFAULT_VIDEO_PROMPT,
+    ContentKind.VOICE: DEFAULT_AUDIO_PROMPT,
+    ContentKind.AUDIO: DEFAULT_AUDIO_PROMPT,
+}
 
-    if message.audio:
-        logger.info(
-            "Audio file detected: title=%s mime_type=%s",
-            message.audio.file_name or message.audio.title,
-            message.audio.mime_type,
-        )
-        meta["file"] = message.audio
-        meta["text"] = message.caption
-        meta["mime_type"] = message.audio.mime_type or "audio/mpeg"
-        return ContentKind.AUDIO, meta
 
-    if message.text:
-        logger.info("Text message detected")
-        meta["text"] = message.text
-        return ContentKind.TEXT, meta
+class _DownloadCache:
+    """
+    LRU-кеш скачанных файлов Telegram по file_unique_id: пересланное медиа
+    или повторный вопрос по тому же вложению не качаются заново.
+    Ограничен и по числу файлов, и по суммарному размеру.
+    """
 
-    logger.warning("Unsupported Telegram message type, no known content fields set")
+    def __init__(self, max_entries: int, max_bytes: int):
+        self._items: OrderedDict[str, bytes | bytearray] = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._size = 0
+
+    def get(self, key: str) -> Optional[bytes | bytearray]:
+        data = self._items.get(key)
+        if data is not None:
+            self._items.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes | bytearray) -> None:
+        if len(data) > self._max_bytes or key in self._items:
+            return
+
+        self._items[key] = data
+        self._size += len(data)
+
+        while len(self._items) > self._max_entries or self._size > self._max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self._size -= len(evicted)
 
-    return ContentKind.NONE, meta
+
+_download_cache = _DownloadCache(
+    max_entries=DOWNLOAD_CACHE_MAX_ENTRIES,
+    max_bytes=DOWNLOAD_CACHE_MAX_BYTES,
+)
+
+# HTTP-клиент для потокового скачивания файлов (задаётся из main.py)
+_download_client: Optional[httpx.AsyncClient] = None
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def set_download_client(client: Optional[httpx.AsyncClient]) -> None:
+    """
+    Включает потоковое скачивание файлов Telegram через общий httpx-клиент.
+    Без клиента используется File.download_as_bytearray().
+    """
+    global _download_client
+    _download_client = client
+
+
+async def _fetch(tg_file: File) -> bytes | bytearray:
+    """
+    Скачивает файл потоком сразу в заранее выделенный bytearray.
+    download_as_bytearray() сначала собирает весь ответ в bytes и потом
+    копирует его в bytearray – для крупных медиа это лишний memcpy и
+    двойной пик памяти.
+    """
+    url = tg_file.file_path
+    if _download_client is None or not url or not url.startswith(("https://", "http://")):
+        # локальный Bot API сервер / нет клиента – штатный путь PTB
+        return await tg_file.download_as_bytearray()
+
+    buf = bytearray(tg_file.file_size or 0)
+    view = memoryview(buf)
+    offset = 0
+
+    # URL файла содержит токен бота: исключения httpx печатают его в тексте,
+    # поэтому наружу отдаём NetworkError без URL и без цепочки исключений
+    try:
+        async with _download_client.stream("GET", url) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes(_DOWNLOAD_CHUNK_SIZE):
+                end = offset + len(chunk)
+                if end <= len(buf):
+                    view[offset:end] = chunk
+                else:
+                    # file_size оказался меньше фактического – дописываем в хвост
+                    view.release()
+                    del buf[offset:]
+                    buf.extend(chunk)
+                    view = memoryview(buf)
+                offset = end
+    except httpx.HTTPStatusError as e:
+        raise NetworkError(
+            f"Failed to download file from Telegram: HTTP {e.response.status_code}"
+        ) from None
+    except httpx.HTTPError as e:
+        raise NetworkError(
+            f"Failed to download file from Telegram: {type(e).__name__}"
+        ) from None
+
+    view.release()
+    if offset < len(buf):
+        del buf[offset:]
+    return buf
+
+
+async def _download(file_obj: Any) -> bytes | bytearray:
+    """Скачивает файл Telegram (или берёт его из кеша)."""
+    unique_id = getattr(file_obj, "file_unique_id", None)
+    if unique_id:
+        cached = _download_cache.get(unique_id)
+        if cached is not None:
+            logger.info("File %s taken from download cache", unique_id)
+            return cached
+
+    tg_file = await file_obj.get_file()
+    # bytearray отдаём дальше как есть: копия в bytes удвоила бы пик памяти
+    raw_bytes = await _fetch(tg_file)
+
+    if unique_id:
+        _download_cache.put(unique_id, raw_bytes)
+    return raw_bytes
 
 
 async def parse_message(message: Message) -> ParsedContent:
@@ -200,24 +396,18 @@ async def parse_message(message: Message) -> ParsedContent:
         # Странный кейс, но лучше аккуратно обработать
         return content
 
-    tg_file = await file_obj.get_file()
-    raw_bytes = bytes(await tg_file.download_as_bytearray())
+    raw_bytes = await _download(file_obj)
+    content.text = content.text or _DEFAULT_PROMPTS[kind]
 
     if kind == ContentKind.IMAGE:
         content.image_bytes = raw_bytes
         content.image_mime_type = meta["mime_type"] or "image/jpeg"
-        if not content.text:
-            content.text = DEFAULT_IMAGE_PROMPT
         logger.info("Image downloaded, size: %d bytes", len(content.image_bytes))
 
     elif kind in (ContentKind.FILE, ContentKind.VIDEO):
         content.file_bytes = raw_bytes
         content.file_mime_type = meta["mime_type"]
         content.file_name = meta["file_name"]
-        if not content.text:
-            content.text = (
-                DEFAULT_VIDEO_PROMPT if kind == ContentKind.VIDEO else DEFAULT_FILE_PROMPT
-            )
         logger.info(
             "%s downloaded, name=%s, size=%d bytes",
             "Video" if kind == ContentKind.VIDEO else "File",
@@ -228,8 +418,6 @@ async def parse_message(message: Message) -> ParsedContent:
     elif kind in (ContentKind.VOICE, ContentKind.AUDIO):
         content.audio_bytes = raw_bytes
         content.audio_mime_type = meta["mime_type"]
-        if not content.text:
-            content.text = DEFAULT_AUDIO_PROMPT
         logger.info("Audio downloaded, size: %d bytes", len(content.audio_bytes))
 
     return content
@@ -239,12 +427,11 @@ def to_chat_message(content: ParsedContent) -> Optional[ChatMessage]:
     """
     Преобразует ParsedContent в ChatMessage (наш универсальный формат).
     """
-    if (
-        content.text is None
-        and not content.image_bytes
-        and not content.file_bytes
-        and not content.audio_bytes
-    ):
+    image_bytes = content.image_bytes
+    file_bytes = content.file_bytes
+    audio_bytes = content.audio_bytes
+
+    if content.text is None and not (image_bytes or file_bytes or audio_bytes):
         return None
 
     user_message: ChatMessage = {
@@ -252,34 +439,64 @@ def to_chat_message(content: ParsedContent) -> Optional[ChatMessage]:
         "content": content.text or "",
     }
 
-    if content.image_bytes:
+    if image_bytes:
         user_message["images"] = [
             {
-                "data": content.image_bytes,
+                "data": image_bytes,
                 "mime_type": content.image_mime_type or "image/jpeg",
             }
         ]
 
-    if content.file_bytes:
-        guessed_mime, _ = mimetypes.guess_type(content.file_name or "")
-        mime_type = content.file_mime_type or guessed_mime
+    if file_bytes:
+        mime_type = content.file_mime_type or _guess_mime(content.file_name or "")
         if not mime_type or mime_type == "application/octet-stream":
             mime_type = "text/plain"
 
         user_message["files"] = [
             {
-                "data": content.file_bytes,
+                "data": file_bytes,
                 "mime_type": mime_type,
                 "name": content.file_name,
             }
         ]
 
-    if content.audio_bytes:
+    if audio_bytes:
         user_message["audios"] = [
             {
-                "data": content.audio_bytes,
+                "data": audio_bytes,
                 "mime_type": content.audio_mime_type or "audio/ogg",
             }
         ]
 
     return user_message
+
+
+_MEDIA_PLACEHOLDERS = (
+    ("images", "изображение"),
+    ("audios", "аудио"),
+    ("files", "файл"),
+)
+
+
+def strip_media(message: ChatMessage) -> None:
+    """
+    Убирает из сообщения бинарные вложения (in-place), оставляя текстовую пометку.
+    Вызывается после того, как вложения уже отправлены в LLM, чтобы не
+    пересылать те же байты на каждом следующем ходе диалога. Вложения,
+    которые LLM-клиент заменил ссылкой (uri, см. offload_media), остаются.
+    """
+    notes = []
+    for key, label in _MEDIA_PLACEHOLDERS:
+        items = message.pop(key, None)
+        if not items:
+            continue
+        kept = [item for item in items if "data" not in item]
+        if kept:
+            message[key] = kept
+        if len(kept) < len(items):
+            notes.append(label)
+
+    if notes:
+        note = f"[ранее отправлено: {', '.join(notes)}]"
+        content = message.get("content")
+        message["content"] = f"{content}\n{note}" if content else note
@@ -1,12 +1,17 @@
 from __future__ import annotations
 
 import re
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from config import MAX_TELEGRAM_MESSAGE_LEN
 
 # Набор спецсимволов, которые Telegram требует экранировать в MarkdownV2
 MD_V2_SPECIAL_CHARS = set("_*[]()~`>#+-=|{}.!")
 
+# Таблицы для str.translate: экранирование за один проход на уровне C
+_MD_V2_ESCAPE_TABLE = str.maketrans({c: "\\" + c for c in MD_V2_SPECIAL_CHARS})
+_MD_V2_CODE_ESCAPE_TABLE = str.maketrans({"\\": "\\\\", "`": "\\`"})
+_MD_V2_LINK_URL_ESCAPE_TABLE = str.maketrans({"(": "\\(", ")": "\\)"})
+
 # Паттерн заголовков вида #..###### Заголовок
 HEADER_RE = re.compile(r"^(#{1,6})\s+(.*)$")
 
@@ -32,6 +37,7 @@ HR_SPLIT_RE = re.compile(
 )
 CODE_FENCE_LINE_RE = re.compile(r"^(`{3,})(.*)$")
 BOLD_LINE_RE = re.compile(r"^\s*\*.+\*\s*$")
+NON_SPACE_RE = re.compile(r"\S")
 
 
 def _escape_md_v2(text: str) -> str:
@@ -39,7 +45,7 @@ def _escape_md_v2(text: str) -> str:
     Экранирует спецсимволы MarkdownV2 во всём тексте.
     Используется для "голого" текста без разметки.
     """
-    return re.sub(r"([_*[\]()~`>#+\-=|{}.!])", r"\\\1", text)
+    return text.translate(_MD_V2_ESCAPE_TABLE)
 
 
 def _escape_md_v2_code(text: str) -> str:
@@ -47,14 +53,14 @@ def _escape_md_v2_code(text: str) -> str:
     Экранирует текст внутри кодовых блоков/инлайн-кода.
     В Telegram внутри кода нужно экранировать только backslash и `.
     """
-    return text.replace("\\", "\\\\").replace("`", "\\`")
+    return text.translate(_MD_V2_CODE_ESCAPE_TABLE)
 
 
 def _escape_md_v2_link_url(url: str) -> str:
     """
     Экранирует URL внутри () части ссылки.
     """
-    return re.sub(r"([()])", r"\\\1", url)
+    return url.translate(_MD_V2_LINK_URL_ESCAPE_TABLE)
 
 
 
@@ -549,9 +555,119 @@ def _parse_blocks(section: str) -> List[Dict[str, str]]:
     return blocks
 
 
-def _smart_split_point(text: str, max_len: int) -> int:
+def _utf16_len(text: str) -> int:
+    """
+    Длина текста в UTF-16 code units – именно так Telegram считает лимит.
+    Символы вне BMP (большинство emoji) занимают две единицы.
+    """
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _utf16_end(text: str, start: int, max_units: int) -> int:
     """
-    Ищет "красивую" позицию разрыва в пределах max_len (для обычного текста).
+    Конец самого длинного среза text[start:end], который укладывается
+    в max_units UTF-16 code units; символ вне BMP не разрезается.
+    """
+    end = start + max_units
+    window = text[start:end]
+    if window.isascii():
+        return start + len(window)
+    encoded = window.encode("utf-16-le")
+    if len(encoded) <= 2 * max_units:
+        return start + len(window)
+    # "ignore" отбрасывает половину суррогатной пары на границе
+    return start + len(encoded[: 2 * max_units].decode("utf-16-le", "ignore"))
+
+
+def _hard_cut(text: str, start: int, end: int) -> int:
+    """
+    Позиция жёсткого разреза не дальше end, не отрывающая "\\" от
+    экранируемого им символа (иначе оба куска – невалидный MarkdownV2).
+    """
+    i = end
+    while i > start and text[i - 1] == "\\":
+        i -= 1
+    if (end - i) % 2 and end - 1 > start:
+        return end - 1
+    return end
+
+
+# Токены MarkdownV2, влияющие на незакрытые сущности: экранирование,
+# инлайн-код, URL ссылки и маркеры форматирования
+_ENTITY_TOKEN_RE = re.compile(
+    r"\\.|`(?:\\.|[^`\\])*(?P<code_end>`)?|\]\((?:\\.|[^)\\])*\)?|\|\||__|[*_~]",
+    re.DOTALL,
+)
+
+
+# Ссылка MarkdownV2 целиком: [текст](url)
+_MD_LINK_RE = re.compile(r"\[(?:\\.|[^\]\\])*\]\((?:\\.|[^)\\])*\)", re.DOTALL)
+
+
+def _link_safe_split(text: str, start: int, split_at: int) -> int:
+    """
+    Если разрез split_at пришёлся внутрь ссылки [текст](url), переносит его
+    на начало ссылки – разрезанная ссылка в обоих сообщениях невалидна.
+    Ссылку длиннее целого сообщения оставляем как есть.
+    """
+    idx = text.rfind("[", start, split_at)
+    if idx <= start:
+        # нет "[" в окне или ссылка начинается с начала куска
+        return split_at
+    i = idx
+    while i > start and text[i - 1] == "\\":
+        i -= 1
+    if (idx - i) % 2:
+        # "\[" – экранированная скобка, а не ссылка
+        return split_at
+    m = _MD_LINK_RE.match(text, idx)
+    if m and m.end() > split_at:
+        return idx
+    return split_at
+
+
+def _entities_at(
+    tokens: List[re.Match],
+    idx: int,
+    stack: List[str],
+    split_at: int,
+) -> Tuple[List[str], int, List[str]]:
+    """
+    Состояние сущностей MarkdownV2 (*, _, __, ~, ||, `) в позиции split_at.
+    tokens – все совпадения _ENTITY_TOKEN_RE в блоке, stack/idx – уже
+    посчитанное состояние (маркеры в порядке открытия и первый
+    необработанный токен); состояние не меняется, функция возвращает новое.
+
+    Возвращает (stack, idx, openers): openers – маркеры, открытые в
+    split_at, их закрываем в конце сообщения и открываем в следующем.
+    """
+    stack = list(stack)
+    while idx < len(tokens) and tokens[idx].start() < split_at:
+        m = tokens[idx]
+        token = m.group()
+        if m.end() > split_at:
+            # токен пересекает разрез: инлайн-код остаётся открытым,
+            # URL ссылки сущностью форматирования не является
+            return stack, idx, stack + ["`"] if token[0] == "`" else stack
+        if token[0] == "`":
+            if m.group("code_end") is None:
+                stack.append("`")
+        elif token[0] not in "\\]":
+            if token in stack:
+                del stack[len(stack) - 1 - stack[::-1].index(token)]
+            else:
+                stack.append(token)
+        idx += 1
+    return stack, idx, stack
+
+
+def _smart_split_point(text: str, max_len: int, start: int = 0) -> int:
+    """
+    Ищет "красивую" позицию разрыва в окне от start длиной max_len
+    UTF-16 code units (для обычного текста). Возвращает абсолютный индекс
+    в text; поиск идёт по индексам.
 
     Приоритет деления:
       - по двойным переводам строк (\n\n)
@@ -559,45 +675,45 @@ def _smart_split_point(text: str, max_len: int) -> int:
       - по табуляции (\t)
       - по точка+пробел (". ")
       - по пробелу
-      - в противном случае - жёстко режем на max_len
+      - в противном случае - жёстко режем на max_len (не разрывая экранирование)
     """
-    if len(text) <= max_len:
+    end = _utf16_end(text, start, max_len)
+    if end >= len(text):
         return len(text)
 
-    window = text[:max_len]
-
     # \n\n
-    idx = window.rfind("\n\n")
+    idx = text.rfind("\n\n", start, end)
     if idx != -1:
         return idx + 2
 
     # \n
-    idx = window.rfind("\n")
+    idx = text.rfind("\n", start, end)
     if idx != -1:
         return idx + 1
 
     # \t
-    idx = window.rfind("\t")
+    idx = text.rfind("\t", start, end)
     if idx != -1:
         return idx + 1
 
     # ". "
-    idx = window.rfind(". ")
+    idx = text.rfind(". ", start, end)
     if idx != -1:
         return idx + 2
 
     # пробел
-    idx = window.rfind(" ")
+    idx = text.rfind(" ", start, end)
     if idx != -1:
         return idx + 1
 
     # жёсткий разрез
-    return max_len
+    return _hard_cut(text, start, end)
 
 
-def _smart_split_point_code(text: str, max_len: int) -> int:
+def _smart_split_point_code(text: str, max_len: int, start: int = 0) -> int:
     """
-    "Красивый" разрыв для кода (без точки-пробела).
+    "Красивый" разрыв для кода (без точки-пробела) в окне от start длиной
+    max_len UTF-16 code units. Возвращает абсолютный индекс в text.
     Приоритет:
       - \n\n
       - \n
@@ -605,28 +721,27 @@ def _smart_split_point_code(text: str, max_len: int) -> int:
       - пробел
       - иначе жёсткий разрез
     """
-    if len(text) <= max_len:
+    end = _utf16_end(text, start, max_len)
+    if end >= len(text):
         return len(text)
 
-    window = text[:max_len]
-
-    idx = window.rfind("\n\n")
+    idx = text.rfind("\n\n", start, end)
     if idx != -1:
         return idx + 2
 
-    idx = window.rfind("\n")
+    idx = text.rfind("\n", start, end)
     if idx != -1:
         return idx + 1
 
-    idx = window.rfind("\t")
+    idx = text.rfind("\t", start, end)
     if idx != -1:
         return idx + 1
 
-    idx = window.rfind(" ")
+    idx = text.rfind(" ", start, end)
     if idx != -1:
         return idx + 1
 
-    return max_len
+    return _hard_cut(text, start, end)
 
 
 def _split_long_code_block(block_text: str, limit: int) -> List[str]:
@@ -660,24 +775,20 @@ def _split_long_code_block(block_text: str, limit: int) -> List[str]:
         body_lines = lines[1:footer_idx]
         footer = lines[footer_idx]
 
-    header_len = len(header)
-    footer_len = len(footer)
+    header_len = _utf16_len(header)
+    footer_len = _utf16_len(footer)
     max_body = max(1, limit - header_len - footer_len)
 
     body_text = "".join(body_lines)
     chunks: List[str] = []
 
-    rest = body_text
-    while rest:
-        if len(rest) <= max_body:
-            part = rest
-            rest = ""
-        else:
-            split_at = _smart_split_point_code(rest, max_body)
-            part = rest[:split_at]
-            rest = rest[split_at:]
-
-        chunks.append(header + part + footer)
+    # Идём по индексам: каждый кусок вырезается из body_text ровно один раз
+    pos = 0
+    n = len(body_text)
+    while pos < n:
+        split_at = _smart_split_point_code(body_text, max_body, pos)
+        chunks.append(header + body_text[pos:split_at] + footer)
+        pos = split_at
 
     return chunks
 
@@ -708,13 +819,23 @@ def _append_text_block(
     limit: int,
 ) -> (List[str], str):
     """
-    Добавляет текстовый блок в текущий chunk с учётом лимита.
-    Если блок не помещается, режет его по _smart_split_point().
+    Добавляет текстовый блок в текущий chunk с учётом лимита
+    (в UTF-16 code units). Если блок не помещается, режет его по
+    _smart_split_point(); сущность, внутри которой пришёлся разрез,
+    закрывается в конце сообщения и открывается заново в следующем.
+    Блок обходится по индексам (без повторных срезов хвоста), так что
+    длинный текст обрабатывается за линейное время.
     """
     text = block_text
-
-    while text:
-        remaining = limit - len(current)
+    pos = 0
+    n = len(text)
+    # Токены сущностей собираем, только если блок действительно придётся резать
+    tokens: Optional[List[re.Match]] = None
+    token_idx = 0
+    stack: List[str] = []
+
+    while pos < n:
+        remaining = limit - _utf16_len(current)
         if remaining <= 0:
             # Текущий chunk заполнен - отправляем и начинаем новый
             if current.strip():
@@ -722,23 +843,45 @@ def _append_text_block(
             current = ""
             remaining = limit
 
+        split_at = _smart_split_point(text, remaining, pos)
+
         # всё целиком помещается
-        if len(text) <= remaining:
-            current += text
+        if split_at >= n:
+            current += text[pos:]
             break
-
-        # нужно разделить внутри блока
-        split_at = _smart_split_point(text, remaining)
-        # защита от зацикливания
-        if split_at <= 0:
-            # ничего не помещается - вынужденно режем жёстко
-            split_at = remaining
-
-        current += text[:split_at]
-        if current.strip():
-            chunks.append(current.rstrip())
+        split_at = _link_safe_split(text, pos, split_at)
+
+        if tokens is None:
+            tokens = list(_ENTITY_TOKEN_RE.finditer(text))
+        new_stack, new_idx, openers = _entities_at(tokens, token_idx, stack, split_at)
+        closers = "".join(reversed(openers))
+        piece = (current + text[pos:split_at]).rstrip()
+
+        if closers and _utf16_len(piece) + len(closers) > limit:
+            # оставляем место под закрывающие маркеры
+            split_at = _smart_split_point(text, remaining - len(closers), pos)
+            split_at = _link_safe_split(text, pos, split_at)
+            new_stack, new_idx, openers = _entities_at(tokens, token_idx, stack, split_at)
+            closers = "".join(reversed(openers))
+            piece = (current + text[pos:split_at]).rstrip()
+
+        if split_at <= pos and not current.strip():
+            # ничего не помещается даже в пустой chunk - режем жёстко
+            split_at = max(pos + 1, _utf16_end(text, pos, limit))
+            new_stack, new_idx, openers = _entities_at(tokens, token_idx, stack, split_at)
+            closers = "".join(reversed(openers))
+            piece = text[pos:split_at]
+
+        stack, token_idx = new_stack, new_idx
+        if piece.strip():
+            chunks.append(piece + closers)
         current = ""
-        text = text[split_at:].lstrip()
+
+        # пропускаем пробельные символы в начале следующего куска
+        m = NON_SPACE_RE.search(text, split_at)
+        pos = m.start() if m else n
+        if pos < n:
+            current = "".join(openers)
 
     return chunks, current
 
@@ -759,7 +902,7 @@ def _append_code_block(
         код-блоков (см. _split_long_code_block).
     """
     # Блок сам по себе длиннее лимита -> делим его на несколько
-    if len(block_text) > limit:
+    if _utf16_len(block_text) > limit:
         bold_tail = ""
         if current:
             prefix, bold_tail = _detach_last_bold_line(current)
@@ -773,7 +916,7 @@ def _append_code_block(
             piece = piece.rstrip()
             if first and bold_tail:
                 merged = bold_tail + piece
-                if len(merged) <= limit:
+                if _utf16_len(merged) <= limit:
                     chunks.append(merged.rstrip())
                 else:
                     # не поместился вместе - отправляем заголовок отдельно
@@ -786,7 +929,7 @@ def _append_code_block(
         return chunks, current
 
     # Блок умещается в одно сообщение
-    if len(current) + len(block_text) <= limit:
+    if _utf16_len(current) + _utf16_len(block_text) <= limit:
         # просто добавляем к текущему
         current += block_text
         return chunks, current
@@ -840,6 +983,8 @@ def split_md_v2(text: str, limit: int = MAX_TELEGRAM_MESSAGE_LEN) -> List[str]:
            либо делятся на несколько самостоятельных код-блоков,
            если они сами превышают лимит.
       3. В конце все сообщения `strip()`-ятся; пустые/пробельные отбрасываются.
+      4. Лимит считается в UTF-16 code units (как у Telegram): emoji
+         вне BMP занимают две единицы.
     """
     # Сначала делим на секции по горизонтальным разделителям
     sections = _split_on_horizontal_rules(text)
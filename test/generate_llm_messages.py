@@ -44,31 +44,60 @@ PROMPTS: Dict[str, str] = {
 }
 
 
+# Сколько запросов к LLM держим одновременно (ограничение по rate limit)
+MAX_CONCURRENT_REQUESTS = 5
+
+
 async def generate_and_save():
     logger.info("Generating LLM test messages...")
 
     client = GeminiClient()
     LLM_MESSAGES_DIR.mkdir(parents=True, exist_ok=True)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    for key, prompt_text in PROMPTS.items():
-        logger.info("Generating message for prompt '%s'...", key)
+    async def generate_one(key: str, prompt_text: str) -> None:
+        async with semaphore:
+            logger.info("Generating message for prompt '%s'...", key)
 
-        messages: list[ChatMessage] = [
-            {"role": "user", "content": prompt_text},
-        ]
+            messages: list[ChatMessage] = [
+                {"role": "user", "content": prompt_text},
+            ]
+
+            text = await client.generate(messages)
 
-        text = await client.generate(messages)
         if not text:
             logger.error("LLM returned empty message for prompt '%s'", key)
-            continue
+            return
 
         # имя файла формируется из названия промпта
         filename = f"{key}.md"
         out_path = LLM_MESSAGES_DIR / filename
 
-        out_path.write_text(text, encoding="utf-8")
+        # запись на диск – в пул потоков, чтобы не стопорить остальные запросы
+        await asyncio.to_thread(out_path.write_text, text, encoding="utf-8")
         logger.info("Saved LLM message for '%s' to %s", key, out_path)
 
+    # return_exceptions: ошибка одного промпта (например, 429) не должна
+    # закрывать клиент, пока остальные запросы ещё выполняются
+    try:
+        results = await asyncio.gather(
+            *(generate_one(key, prompt_text) for key, prompt_text in PROMPTS.items()),
+            return_exceptions=True,
+        )
+    finally:
+        await client.aclose()
+
+    failed = []
+    for key, result in zip(PROMPTS, results):
+        if isinstance(result, BaseException):
+            logger.error(
+                "Failed to generate message for prompt '%s'", key, exc_info=result
+            )
+            failed.append(key)
+
+    if failed:
+        raise RuntimeError(f"Failed to generate LLM messages for: {', '.join(failed)}")
+
 
 async def main():
     await generate_and_save()
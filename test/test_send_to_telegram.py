@@ -9,9 +9,11 @@ from __future__ import annotations
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pytest
+import pytest_asyncio
 
 from telegram import Bot
 from telegram.constants import ParseMode
@@ -26,11 +28,26 @@ from telegram_bot.handlers import send_reply
 MESSAGES_DIR = Path(__file__).parent / "llm_messages"
 
 
-def _get_message_files() -> list[Path]:
-    files = sorted(MESSAGES_DIR.glob("*.md"))
-    if not files:
+def _get_message_names() -> list[str]:
+    # На этапе сбора нужны только имена: файлы читаются позже в фикстурах
+    names = sorted(p.name for p in MESSAGES_DIR.glob("*.md"))
+    if not names:
         pytest.skip(f"Не найдено ни одного файла в {MESSAGES_DIR}")
-    return files
+    return names
+
+
+@pytest.fixture
+def path(request) -> Path:
+    return MESSAGES_DIR / request.param
+
+
+@pytest.fixture(scope="session")
+def llm_messages() -> dict[str, str]:
+    """Все тестовые сообщения, прочитанные один раз и параллельно: {имя файла: текст}."""
+    files = sorted(MESSAGES_DIR.glob("*.md"))
+    with ThreadPoolExecutor() as pool:
+        texts = pool.map(lambda p: p.read_text(encoding="utf-8"), files)
+        return {p.name: text for p, text in zip(files, texts)}
 
 
 class TelegramTestMessage:
@@ -48,25 +65,26 @@ class TelegramTestMessage:
         )
 
 
-@pytest.fixture
-def telegram_test_context() -> tuple[Bot, int]:
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def telegram_test_context() -> tuple[Bot, int]:
+    # Один Bot на всю сессию: TLS-соединения к api.telegram.org переиспользуются
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     chat_id_str = os.environ.get("TELEGRAM_TEST_CHAT_ID")
 
     if not token or not chat_id_str:
         pytest.skip("TELEGRAM_BOT_TOKEN или TELEGRAM_TEST_CHAT_ID не заданы в окружении")
 
-    bot = Bot(token=token)
     chat_id = int(chat_id_str)
-    return bot, chat_id
+    async with Bot(token=token) as bot:
+        yield bot, chat_id
 
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 @pytest.mark.integration
-@pytest.mark.parametrize("path", _get_message_files())
-async def test_send_to_telegram(path: Path, telegram_test_context):
+@pytest.mark.parametrize("path", _get_message_names(), indirect=True)
+async def test_send_to_telegram(path: Path, telegram_test_context, llm_messages):
     bot, chat_id = telegram_test_context
-    content = path.read_text(encoding="utf-8")
+    content = llm_messages[path.name]
     msg = TelegramTestMessage(bot, chat_id)
     prefix = "`" + path.name + "`\n\n"
     content = prefix + content
@@ -81,7 +99,9 @@ async def test_send_to_telegram(path: Path, telegram_test_context):
             f"но пришёл {parse_mode!r} (файл: {path.name}, chunk #{idx})"
         )
         assert text, f"Пустой chunk недопустим (файл: {path.name}, chunk #{idx})"
-        assert len(text) <= MAX_TELEGRAM_MESSAGE_LEN, (
+        # Telegram считает длину в UTF-16 code units (эмодзи – две единицы)
+        utf16_len = len(text.encode("utf-16-le")) // 2
+        assert utf16_len <= MAX_TELEGRAM_MESSAGE_LEN, (
             f"Chunk превышает лимит {MAX_TELEGRAM_MESSAGE_LEN} символов "
-            f"(файл: {path.name}, chunk #{idx}, длина={len(text)})"
+            f"(файл: {path.name}, chunk #{idx}, длина UTF-16={utf16_len})"
         )
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Офлайн-тесты split_md_v2 для текста с символами вне BMP (emoji):
+лимит Telegram считается в UTF-16 code units, а разрез не должен
+ломать экранирование и сущности MarkdownV2.
+"""
+
+from __future__ import annotations
+
+import math
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from config import MAX_TELEGRAM_MESSAGE_LEN
+from telegram_bot.utils import convert_to_md_v2, split_md_v2
+
+# Нечётное число "\" в конце – последний экранирует символ из следующего сообщения
+TRAILING_ESCAPE_RE = re.compile(r"(?<!\\)(?:\\\\)*\\$")
+
+
+def _utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "😀." * 2500,
+        "**" + "😀a" * 2500 + "**",
+        "word 😀 " * 3000,
+        "`" + "x😀" * 3000 + "`",
+        "_" + "слово 😀 " * 1500 + "_",
+    ],
+    ids=["escapes", "bold", "words", "inline_code", "italic_words"],
+)
+def test_chunks_fit_utf16_limit_and_keep_markup_valid(source: str):
+    chunks = split_md_v2(convert_to_md_v2(source))
+
+    assert len(chunks) > 1
+    for idx, chunk in enumerate(chunks):
+        assert _utf16_len(chunk) <= MAX_TELEGRAM_MESSAGE_LEN, f"chunk #{idx}"
+        assert not TRAILING_ESCAPE_RE.search(chunk), f"chunk #{idx} ends with bare '\\'"
+
+
+def test_escape_is_not_split_from_escaped_char():
+    chunks = split_md_v2(convert_to_md_v2("😀." * 2500))
+
+    assert "".join(chunks) == convert_to_md_v2("😀." * 2500)
+    for chunk in chunks:
+        assert not chunk.startswith("."), "unescaped '.' at chunk start"
+
+
+def test_entity_is_closed_and_reopened_across_chunks():
+    chunks = split_md_v2(convert_to_md_v2("**" + "😀a" * 2500 + "**"))
+
+    for chunk in chunks:
+        assert chunk.startswith("*") and chunk.endswith("*")
+        assert chunk.count("*") == 2
+
+
+def test_no_stub_messages_for_emoji_dense_text():
+    md = convert_to_md_v2("word 😀 " * 3000)
+
+    chunks = split_md_v2(md)
+
+    # Каждое сообщение заполняется почти до лимита, без коротких "хвостов"
+    assert len(chunks) == math.ceil(_utf16_len(md) / MAX_TELEGRAM_MESSAGE_LEN)